@@ -24,9 +24,116 @@ along with Unlyme.  If not, see <http://www.gnu.org/licenses/>.
 import os
 import io
 import struct
+import ntpath
 import pathlib
 import zlib
 import warnings
+import threading
+import contextlib
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    # Optional libdeflate bindings, faster for whole members
+    import deflate
+except ImportError:
+    deflate = None
+
+
+# Precompiled formats for the TOC fields, indexed by endian
+_S_I = {e: struct.Struct(e + 'I') for e in '<>'}
+_S_Ib = {e: struct.Struct(e + 'Ib') for e in '<>'}
+_S_III = {e: struct.Struct(e + 'III') for e in '<>'}
+
+
+def _fileno(fd):
+    """
+    Get the descriptor of a file object that accesses a plain file
+
+    Wrappers like GzipFile also have a fileno(), but the descriptor is
+    the one of the compressed file, so their data cannot be read from it.
+
+    Args:
+        fd: A file object
+
+    Returns:
+        The descriptor of the file or None
+    """
+    buffered = (io.BufferedReader, io.BufferedWriter, io.BufferedRandom)
+    if isinstance(fd, buffered):
+        fd = fd.raw
+    if isinstance(fd, io.FileIO):
+        return fd.fileno()
+    return None
+
+
+def _preadinto(fd, view, offset, lock=None):
+    """
+    Fill a buffer reading from a fixed position of the file
+
+    When the file is a plain file on disk os.preadv is used, so the file
+    position is not modified and several threads can read at the same time.
+    In other case the seek and read are done holding the lock.
+
+    Args:
+        fd: A file object
+        view: A writable memoryview
+        offset: Position in the file of the first byte to read
+        lock: Lock shared by all the users of fd, None if it is not shared
+
+    Returns:
+        Number of bytes read, less than the view size only at the EOF
+    """
+    fileno = _fileno(fd) if hasattr(os, 'preadv') else None
+
+    if fileno is None:
+        with lock or contextlib.nullcontext():
+            fd.seek(offset, io.SEEK_SET)
+            return fd.readinto(view)
+
+    total = 0
+    while total < len(view):
+        n = os.preadv(fileno, [view[total:]], offset + total)
+        if n == 0:
+            break
+        total += n
+    return total
+
+
+def _normpath(path):
+    """
+    Normalize a windows path as PureWindowsPath does
+
+    The separators are converted to backslashes and the '.' parts and
+    the repeated or trailing separators are removed. Unlike
+    ntpath.normpath the '..' parts are kept.
+
+    Args:
+        path: A string or path object
+
+    Returns:
+        The normalized path as a string
+    """
+    drive, rest = ntpath.splitdrive(os.fspath(path).replace('/', '\\'))
+    root = '\\' if rest.startswith('\\') else ''
+    parts = [part for part in rest.split('\\') if part not in ('', '.')]
+    return drive + root + '\\'.join(parts) or '.'
+
+
+def _path_key(path):
+    """
+    Normalize a windows path to compare it with the TOC names
+
+    Like PureWindowsPath equality it ignores the case, the kind of
+    separator, the '.' parts and the repeated or trailing separators.
+
+    Args:
+        path: A string or path object
+
+    Returns:
+        The key of the path in the LymeFile index
+    """
+    return ntpath.normcase(_normpath(path))
 
 
 class LymeError(Exception):
@@ -39,6 +146,7 @@ class LymeInfo:
 
     Attributes:
         path: A PureWindowsPath with the name of the file or directory
+        path_str: The name as stored in the TOC
         is_dir: Flag to mark the entry as a folder
         offset: Byte offset from the start of the Lyme File.
         length: Byte length of the original file
@@ -50,15 +158,17 @@ class LymeInfo:
         the LymeFile tries to correct this using a bias during the extraction.
     """
 
+    # There is one object per TOC entry, so do not use a __dict__
+    __slots__ = ('_path_str', '_path', 'is_dir', 'offset', 'length', 'size')
+
     @classmethod
-    def from_fd(cls, fd, old, endian='>'):
+    def from_buffer(cls, buf, cursor, old, endian='>'):
         """
-        Read the description from the current position in the file
+        Read the description that ends at cursor in a TOC buffer
 
         Notice that this method shall only be used from LymeFile
-        The fd final state will be at the beginning of the next element.
 
-        The structure goes backwards from the end of the file with:
+        The structure goes backwards from the cursor with:
         Bytes          Type  Content
             4  unsigned int   offset
             4  unsigned int   length
@@ -71,48 +181,77 @@ class LymeInfo:
         folders in that case is that both offset and size are 0
 
         Args:
-            fd: A file descriptor
+            buf: Bytes with the TOC, or the part of it before cursor
+            cursor: Position in buf just after the end of the record
             old: flag to use the old format
             endian: One of > or < for little or big endian coding
 
         Returns:
-            A new LymeInfo object
-
+            A new LymeInfo object and the position of the start of the
+            record in buf, that is the cursor of the next element.
+            None if buf does not hold the complete record.
         """
-        assert(isinstance(fd, io.BufferedIOBase))
+        return cls._make_parser(old, endian)(buf, cursor)
 
-        # First bytes: length of the path and directory flag
-        if old:
-            ini = 4
-            fd.seek(-ini, io.SEEK_CUR)
-            raw = fd.read(ini)
-            n, = struct.unpack(endian + 'I', raw)
-            flag = None
-        else:
-            ini = 5
-            fd.seek(-ini, io.SEEK_CUR)
-            raw = fd.read(ini)
-            n, flag = struct.unpack(endian + 'Ib', raw)
+    @classmethod
+    @functools.lru_cache(maxsize=None)
+    def _make_parser(cls, old, endian='>'):
+        """
+        Create a version of from_buffer specialized for a TOC format
 
-        # Now go back the full record: offset + length + size + name
-        fd.seek(-(ini + n + 3*4), io.SEEK_CUR)
+        The structures are bound to the returned function, so parsing
+        each record does not need to select them again.
+        There is only one parser for each format, created on first use.
 
-        # Read only the 3 bytes of the file position and the name
-        raw = fd.read(3*4 + n)
-        offset, length, size = struct.unpack(endian + 'III', raw[:12])
-        # TODO: It is enough here using the decode with UTF-8?
-        path = raw[12:].decode()
+        Args:
+            old: flag to use the old format
+            endian: One of > or < for little or big endian coding
 
-        # Go back to the start of this record
-        fd.seek(-len(raw), io.SEEK_CUR)
+        Returns:
+            A function parse(buf, cursor) with the result of from_buffer
+        """
+        prefix = _S_III[endian].unpack_from
 
         if old:
-            # Determine the directory flag
-            is_dir = offset == 0 and size == 0
+            trailer = _S_I[endian].unpack_from
+
+            def parse(buf, cursor):
+                # First bytes: length of the path
+                cursor -= 4
+                if cursor < 0:
+                    return None
+                n, = trailer(buf, cursor)
+
+                # Now go back the full record: offset + length + size + name
+                start = cursor - (3*4 + n)
+                if start < 0:
+                    return None
+                offset, length, size = prefix(buf, start)
+                path = buf[start + 12:cursor].decode('utf-8')
+
+                # Determine the directory flag
+                is_dir = offset == 0 and size == 0
+                return cls(path, is_dir, offset, length, size), start
         else:
-            is_dir = flag == 1
+            trailer = _S_Ib[endian].unpack_from
+
+            def parse(buf, cursor):
+                # First bytes: length of the path and directory flag
+                cursor -= 5
+                if cursor < 0:
+                    return None
+                n, flag = trailer(buf, cursor)
+
+                # Now go back the full record: offset + length + size + name
+                start = cursor - (3*4 + n)
+                if start < 0:
+                    return None
+                offset, length, size = prefix(buf, start)
+                path = buf[start + 12:cursor].decode('utf-8')
 
-        return cls(path, is_dir, offset, length, size)
+                return cls(path, flag == 1, offset, length, size), start
+
+        return parse
 
     def __init__(self, path, is_dir, offset, length, size):
         """
@@ -127,19 +266,36 @@ class LymeInfo:
         """
         super().__init__()
 
-        self.path = pathlib.PureWindowsPath(path)
+        self._path_str = path
+        self._path = None
         self.is_dir = is_dir
         self.offset = offset
         self.length = length
         self.size = size
 
+    @property
+    def path_str(self):
+        """
+        The path as stored in the TOC, without any conversion
+        """
+        return self._path_str
+
+    @property
+    def path(self):
+        """
+        The path as a PureWindowsPath, built on first access
+        """
+        if self._path is None:
+            self._path = pathlib.PureWindowsPath(self._path_str)
+        return self._path
+
     def __repr__(self):
         return "{}({}, {}, {}, {}, {})".format(
             type(self).__name__, self.path, self.is_dir,
             self.offset, self.length, self.size
         )
 
-    def write(self, fd, bias, out, step=None):
+    def write(self, fd, bias, out, step=None, buf=None, lock=None):
         """
         Extract from fd and write to out
         Args:
@@ -147,30 +303,46 @@ class LymeInfo:
             bias: error in the file position information
             out: File descriptor to write
             step: Maximum bytes to read each time. None means whole file
+            buf: Writable buffer reused to read the data, overrides step
+            lock: Lock to hold when seeking in fd, None if it is not shared
         """
         assert(isinstance(fd, io.BufferedIOBase))
 
-        # Move the file pointer to the start of this element
+        # Start of this element
         start = self.offset + bias
-        fd.seek(start, io.SEEK_SET)
 
         obj = zlib.decompressobj()
         sz = self.size
-        if step is None:
-            # Read the whole file the first time
-            step = sz
+        if buf is None:
+            if step is None:
+                # Read the whole file the first time
+                step = sz
+            buf = bytearray(step)
+        else:
+            step = len(buf)
+        view = memoryview(buf)
         total = 0
         while sz > 0:
             # get next chunk size
             chunk = min(step, sz)
-            raw = fd.read(chunk)
-            if len(raw) != chunk:
+            if _preadinto(fd, view[:chunk], start, lock) != chunk:
                 raise LymeError('Too few data reading {}'.format(self))
+            start += chunk
 
-            data = obj.decompress(raw)
-            out.write(data)
+            try:
+                data = obj.decompress(view[:chunk])
+            except zlib.error:
+                raise LymeError('Corrupted data in {}'.format(self))
             total += len(data)
+            if total > self.length:
+                raise LymeError('Incorrect extracted size')
+            out.write(data)
             sz -= chunk
+
+            # Like in extract, any data after the end of the stream is
+            # ignored, so there is no need to read it
+            if obj.eof:
+                break
         # Small check
         if not obj.eof:
             raise LymeError('Unfinished extractor')
@@ -178,22 +350,32 @@ class LymeInfo:
         if total != self.length:
             raise LymeError('Incorrect extracted size')
 
-    def extract(self, fd, bias):
+    def extract(self, fd, bias, lock=None):
         """
         Extract from fd and write to out
         Args:
             fd: File descriptor to read
             bias: error in the file position information
+            lock: Lock to hold when seeking in fd, None if it is not shared
         """
         assert(isinstance(fd, io.BufferedIOBase))
 
-        # Move the file pointer to the start of this element
-        start = self.offset + bias
-        fd.seek(start, io.SEEK_SET)
-
         # Read the raw data
-        raw = fd.read(self.size)
-        data = zlib.decompress(raw)
+        raw = bytearray(self.size)
+        start = self.offset + bias
+        if _preadinto(fd, memoryview(raw), start, lock) != self.size:
+            raise LymeError('Too few data reading {}'.format(self))
+        # The expanded length is known, so allocate the output only once
+        if deflate is None:
+            try:
+                data = zlib.decompress(raw, zlib.MAX_WBITS, self.length)
+            except zlib.error:
+                raise LymeError('Corrupted data in {}'.format(self))
+        else:
+            try:
+                data = bytes(deflate.zlib_decompress(raw, self.length))
+            except deflate.DeflateError:
+                raise LymeError('Corrupted data in {}'.format(self))
 
         if len(data) != self.length:
             raise LymeError('Incorrect extracted size')
@@ -216,7 +398,9 @@ class LymeFile:
     """
     _Signature = b'!LYME_SFX!'
     _Version = b'1.10'
-    _Chunk = 8096
+    _Chunk = 1 << 18
+    _Window = 1 << 16
+    _IOBuffer = 1 << 20
 
     @classmethod
     def _find_signature(cls, fd):
@@ -233,40 +417,46 @@ class LymeFile:
 
         sz = len(cls._Version) + len(cls._Signature)
         # Start searching from the end of file for the footer
-        # Go to the end of the file and read the header
-        try:
-            fd.seek(-sz, io.SEEK_END)
-        except OSError:
+        end = fd.seek(0, io.SEEK_END)
+        if end < sz:
             raise LymeError('File too short to be a lyme')
 
-        # before the signature the Lyme file shall have the TOC
-        # The smaller Lyme file will have an empty TOC of just 0x00000000
-        while fd.tell() >= 4:
-            raw = fd.read(sz)
-
-            if raw.endswith(cls._Signature):
+        # Read growing blocks from the end of the file until the signature
+        # appears with room enough for the version before it
+        window = cls._Window
+        start = end
+        raw = b''
+        while True:
+            # Only the bytes not read yet, plus the ones that a signature
+            # and version could share with the previous block
+            prev, start = start, max(start - window, 0)
+            fd.seek(start, io.SEEK_SET)
+            raw = fd.read(prev - start) + raw[:sz - 1]
+            pos = raw.rfind(cls._Signature)
+            if pos >= len(cls._Version) or start == 0:
                 break
+            window *= 2
 
-            # Ok, try one byte before
-            fd.seek(-(sz + 1), io.SEEK_CUR)
-        else:
+        # before the signature the Lyme file shall have the TOC
+        # The smaller Lyme file will have an empty TOC of just 0x00000000
+        if start + pos < len(cls._Version) + 4:
             raise LymeError('Not a Lyme file [signature not found]')
 
         # Suffix start where the signature ends
-        suffix = fd.tell()
+        suffix = start + pos + len(cls._Signature)
 
         # Check the version
-        version = raw[:len(cls._Version)]
+        version = raw[pos - len(cls._Version):pos]
         if version != cls._Version:
             warnings.warn(
                 'Version mismatch {} != {}'.format(version, cls._Version)
             )
         # Go to start of TOC
-        fd.seek(-sz, os.SEEK_CUR)
+        fd.seek(suffix - sz, io.SEEK_SET)
         return suffix
 
-    @staticmethod
-    def _read_toc(fd, old=False, endian=None):
+    @classmethod
+    def _read_toc(cls, fd, old=False, endian=None):
         """
         Read the complete TOC
 
@@ -278,44 +468,70 @@ class LymeFile:
         Returns:
             The TOC as a list of LymeInfo
             bias of the last record
+            offset of the first record, that is the end of the SFX block
         """
         assert(isinstance(fd, io.BufferedIOBase))
 
+        # Read the end of the TOC in a single block, more data is read
+        # only when a record goes beyond the start of the block
+        end = fd.tell()
+        base = max(end - cls._Window, 0)
+        fd.seek(base, io.SEEK_SET)
+        buf = fd.read(end - base)
+        if len(buf) < 4:
+            raise LymeError('Not a Lyme file [TOC not found]')
+
         # Fist 4 bytes are the number of elements
-        fd.seek(-4, io.SEEK_CUR)
-        raw = fd.read(4)
+        raw = buf[-4:]
 
         if endian is None or endian == 'auto':
             # Ok, try to determine it, assume that the number of
             # files cannot be huge, so choose the one that produces
             # the smaller number of entries
-            big, = struct.unpack('>I', raw)
-            little, = struct.unpack('<I', raw)
-            if big <= little:
-                endian = '>'
-                n = big
-            else:
-                endian = '<'
-                n = little
+            big = int.from_bytes(raw, 'big')
+            little = int.from_bytes(raw, 'little')
+            endian, n = ('>', big) if big <= little else ('<', little)
         else:
-            n, = struct.unpack(endian + 'I', raw)
+            n, = _S_I[endian].unpack(raw)
 
         # Go back to the start of the first TOC element
-        fd.seek(-4, io.SEEK_CUR)
+        cursor = len(buf) - 4
         last = 0
+        first = None
         toc = []
+        parse = LymeInfo._make_parser(old, endian)
         while len(toc) < n:
-            info = LymeInfo.from_fd(fd, old, endian)
+            record = parse(buf, cursor)
+            if record is None:
+                # Incomplete record, prepend a block as big as the current
+                if base == 0:
+                    raise LymeError('Truncated TOC')
+                start = max(base - len(buf), 0)
+                fd.seek(start, io.SEEK_SET)
+                extra = fd.read(base - start)
+                buf = extra + buf
+                cursor += len(extra)
+                base = start
+                continue
+
+            info, cursor = record
             toc.append(info)
             if info.is_dir:
                 continue
             # Calculate the last position of this record to obtain bias
             last = max(last, info.offset + info.size)
+            # And the first one for the length of the SFX block
+            if first is None or info.offset < first:
+                first = info.offset
 
         # Current position is the end of the last file stored in the
         # Lymefile, but that might not be equal to the offset value
-        bias = fd.tell() - last
-        return toc, bias
+        bias = base + cursor - last
+
+        # Without files all the data before the TOC is the SFX block
+        if first is None:
+            first = last
+        return toc, bias, first
 
     def __init__(self, fd, old=False, endian=None):
         """
@@ -330,15 +546,19 @@ class LymeFile:
         if isinstance(fd, io.BufferedIOBase):
             self._fd = fd
         else:
-            self._fd = open(fd, 'rb')
+            self._fd = open(fd, 'rb', buffering=self._IOBuffer)
+
+        # Held by every seek in self._fd after the initialization
+        self._lock = threading.Lock()
 
         self._suffix = self._find_signature(self._fd)
 
         # Now read the TOC
-        self._toc, self._bias = self._read_toc(self._fd, old, endian)
+        self._toc, self._bias, sfx = self._read_toc(self._fd, old, endian)
 
-        # And get the length of the SFX block
-        sfx = min(entry.offset for entry in self._toc if not entry.is_dir)
+        # Index the entries by path, the last one in the TOC wins
+        self._index = {_path_key(entry.path_str): entry for entry in self._toc}
+        self._members = {id(entry) for entry in self._toc}
 
         # Take into account the bias for the end of the SFX block
         self._sfx = sfx + self._bias
@@ -353,31 +573,38 @@ class LymeFile:
             The bytes of the data or None for directories
         """
         if isinstance(member, LymeInfo):
-            if member not in self._toc:
+            if id(member) not in self._members:
                 raise LymeError('The LymeInfo is not part of the LymeFile')
 
         else:
-            path = pathlib.PureWindowsPath(member)
-            for entry in self._toc:
-                if entry.path == path:
-                    member = entry
-                    break
-            else:
+            entry = self._index.get(_path_key(member))
+            if entry is None:
                 raise LymeError('{} not found'.format(member))
+            member = entry
 
         # Ok, now member is an entry of the current LymeFile
         if member.is_dir:
             return None
-        return member.extract(self._fd, self._bias)
+        return member.extract(self._fd, self._bias, self._lock)
 
-    def extractall(self, path='.', step=None):
+    def extractall(self, path='.', step=None, workers=None):
         """
         Try to extract all the elements of the lime object
+
+        The folders are created first and then the files are extracted
+        in parallel, all the workers reading from the same file.
+        Files that do not support positional reads, like a GzipFile,
+        are always extracted in the current thread.
+
         Args:
             path: Directory to extract to
-            step: Buffer size to read the files
+            step: Buffer size to read the files (Default _Chunk)
+            workers: Maximum number of threads. None for os.cpu_count()
         """
-        os.makedirs(path, exist_ok=True)
+        step = step or self._Chunk
+
+        folders = {path}
+        files = {}
         for entry in self._toc:
             assert(isinstance(entry, LymeInfo))
 
@@ -392,14 +619,46 @@ class LymeFile:
             target = os.path.join(path, target)
 
             if entry.is_dir:
-                os.makedirs(target, exist_ok=True)
+                folders.add(target)
                 continue
             else:
                 # Try to create any intermediate folder
-                os.makedirs(os.path.dirname(target), exist_ok=True)
-
+                folders.add(os.path.dirname(target))
+
+            # Only the last entry with the same name is preserved, even
+            # when the names only differ in the case
+            files[_path_key(target)] = target, entry
+
+        # Create each folder once, the parents first
+        for folder in sorted(folders, key=len):
+            os.makedirs(folder, exist_ok=True)
+
+        # Seeking from several threads would be much slower than reading
+        # all the files in order
+        if workers == 1 or _fileno(self._fd) is None:
+            buf = bytearray(step)
+            for target, entry in files.values():
+                with open(target, 'wb') as out:
+                    entry.write(
+                        self._fd, self._bias, out, buf=buf, lock=self._lock
+                    )
+            return
+
+        local = threading.local()
+
+        def write(item):
+            target, entry = item
+            if not hasattr(local, 'buf'):
+                local.buf = bytearray(step)
             with open(target, 'wb') as out:
-                entry.write(self._fd, self._bias, out, step)
+                entry.write(
+                    self._fd, self._bias, out, buf=local.buf, lock=self._lock
+                )
+
+        with ThreadPoolExecutor(workers or os.cpu_count()) as pool:
+            # Consume the results to raise any error in the workers
+            for _ in pool.map(write, files.values()):
+                pass
 
     def sfx(self):
         """
@@ -407,8 +666,51 @@ class LymeFile:
         Returns:
             The bytes of the self extractor
         """
-        self._fd.seek(0, io.SEEK_SET)
-        return self._fd.read(self._sfx)
+        with self._lock:
+            self._fd.seek(0, io.SEEK_SET)
+            return self._fd.read(self._sfx)
+
+    def sfx_to(self, out):
+        """
+        Write the self extract block to a file
+
+        When both are plain files the data is copied by the kernel with
+        os.sendfile, in other case it is copied in chunks.
+
+        Args:
+            out: File opened in binary mode
+        """
+        src = _fileno(self._fd)
+        dst = _fileno(out)
+        if src is not None and dst is not None and hasattr(os, 'sendfile'):
+            out.flush()
+            sent = 0
+            try:
+                while sent < self._sfx:
+                    n = os.sendfile(dst, src, sent, self._sfx - sent)
+                    if n == 0:
+                        raise LymeError('Too few data reading the SFX block')
+                    sent += n
+            except OSError:
+                # Unsupported by these files, but do not write twice
+                if sent > 0:
+                    raise
+            else:
+                # Keep the position of out in sync with its descriptor
+                if out.seekable():
+                    out.seek(os.lseek(dst, 0, io.SEEK_CUR), io.SEEK_SET)
+                return
+
+        view = memoryview(bytearray(min(self._Chunk, self._sfx)))
+        with self._lock:
+            self._fd.seek(0, io.SEEK_SET)
+            left = self._sfx
+            while left > 0:
+                n = self._fd.readinto(view[:min(left, len(view))])
+                if not n:
+                    raise LymeError('Too few data reading the SFX block')
+                out.write(view[:n])
+                left -= n
 
     def suffix(self):
         """
@@ -416,8 +718,9 @@ class LymeFile:
         Returns:
             The bytes written after the footer
         """
-        self._fd.seek(self._suffix)
-        return self._fd.read()
+        with self._lock:
+            self._fd.seek(self._suffix)
+            return self._fd.read()
 
     def list(self, posix=True):
         """
@@ -425,18 +728,16 @@ class LymeFile:
         Args:
             posix: Use posix paths
         """
-        out = []
-        sp = 0
-        for entry in self._toc:
-            if posix:
-                path = entry.path.as_posix()
-            else:
-                path = str(entry.path)
-            sp = max(sp, len(path))
-            if entry.is_dir:
-                out.append((path, ''))
-            else:
-                out.append((path, entry.length))
-
-        for path, length in out:
-            print('{} {}'.format(path.ljust(sp), length))
+        # The same names that PureWindowsPath, and extractall, produce
+        paths = [_normpath(entry.path_str) for entry in self._toc]
+        if posix:
+            paths = [path.replace('\\', '/') for path in paths]
+        if not paths:
+            return
+
+        # Build the whole listing to print it at once
+        sp = max(map(len, paths))
+        print('\n'.join(
+            '{} {}'.format(path.ljust(sp), '' if e.is_dir else e.length)
+            for path, e in zip(paths, self._toc)
+        ))